@@ -19,9 +19,14 @@
 
 
 import argparse
+import array
 import datetime
+import functools
+import io
+import mmap
 from pathlib import Path
 import struct
+import sys
 from typing import Any, List, Literal, Optional
 from xml.etree import ElementTree as etree
 
@@ -35,43 +40,116 @@ XBIN_MAGIC_BE = XBIN_MAGIC + b'\x12\x34'
 XBIN_MAGIC_LE = XBIN_MAGIC + b'\x34\x12'
 FDGH_MAGIC_BE = b'FDGH'
 FDGH_MAGIC_LE = b'HGDF'
+XBIN_MAGIC_ENDIANNESS = {XBIN_MAGIC_BE: '>', XBIN_MAGIC_LE: '<'}
+FDGH_MAGIC_ENDIANNESS = {FDGH_MAGIC_BE: '>', FDGH_MAGIC_LE: '<'}
+ENDIANNESS_XBIN_MAGIC = {'>': XBIN_MAGIC_BE, '<': XBIN_MAGIC_LE}
+ENDIANNESS_FDGH_MAGIC = {'>': FDGH_MAGIC_BE, '<': FDGH_MAGIC_LE}
+ENDIANNESS_NAMES = {'>': 'big', '<': 'little'}
+NAME_ENDIANNESS = {'big': '>', 'little': '<'}
+
+# XBIN v4+ files end with this (magic, then 8 null bytes)
+ENDIANNESS_XBIN_COLR = {'>': b'COLR' + b'\0' * 8, '<': b'RLOC' + b'\0' * 8}
+
+# XBIN header size for each version. All offsets in the embedded data
+# are relative to the start of the XBIN, so these are also the
+# adjustments needed for them.
+XBIN_HEADER_SIZES = {2: 0x10, 4: 0x14, 5: 0x14}
+
+# Precompiled structs for fixed formats, keyed by endianness
+STRUCT_U32 = {end: struct.Struct(end + 'I') for end in '<>'}
+STRUCT_U64 = {end: struct.Struct(end + 'Q') for end in '<>'}
+STRUCT_2U32 = {end: struct.Struct(end + '2I') for end in '<>'}
+STRUCT_3U32 = {end: struct.Struct(end + '3I') for end in '<>'}
+STRUCT_4U32 = {end: struct.Struct(end + '4I') for end in '<>'}
+
+# Native byte order, and the array.array typecode for native U32s (if
+# there is one)
+NATIVE_ENDIANNESS = '<' if sys.byteorder == 'little' else '>'
+U32_ARRAY_TYPECODE = next(
+    (code for code in 'IL' if array.array(code).itemsize == 4), None)
 
 XML_COMMENT = 'This XML file was generated on {} by FDGH Converter 4.0 (https://github.com/RoadrunnerWMC/FDGH-Converter)'
 
 
 # These make the code cleaner!
-def unpack_u32(end: Endianness, *args) -> Any:
-    return struct.unpack(end + 'I', *args)[0]
 def unpack_u32_from(end: Endianness, *args) -> Any:
-    return struct.unpack_from(end + 'I', *args)[0]
-def pack_u32(end: Endianness, *args) -> Any:
-    return struct.pack(end + 'I', *args)
-def pack_u64(end: Endianness, *args) -> Any:
-    return struct.pack(end + 'Q', *args)
+    return STRUCT_U32[end].unpack_from(*args)[0]
+def pack_u32_into(end: Endianness, *args) -> None:
+    STRUCT_U32[end].pack_into(*args)
 
 
-def load_4b_length_prefixed_string(end: Endianness, data: bytes) -> str:
+@functools.lru_cache(maxsize=None)
+def u32_array_struct(end: Endianness, count: int) -> struct.Struct:
     """
-    Load a 4-byte length prefixed string.
+    Get a struct for an array of count U32s. These are cached, since
+    the same few array lengths come up over and over again.
     """
-    strLen = unpack_u32(end, data[:4])
-    return data[4:4+strLen].decode('latin-1')
+    return struct.Struct(f'{end}{count}I')
 
 
-def pack_4b_length_prefixed_padded_string(end: Endianness, string: str, num_null_terminators:int=4) -> bytes:
+def unpack_u32_array_from(end: Endianness, data: bytes, offset: int) -> List[int]:
     """
-    Pack a 4-byte length prefixed string.
+    Unpack a list of U32s preceded by a U32 count, in a single call.
+    This is the inverse of pack_u32_array_into().
+    """
+    count = unpack_u32_from(end, data, offset)
+
+    # array.array is a bit faster than struct for this, but its item
+    # size is platform-dependent, so it can't always be used
+    # (If the data is truncated, this falls through to struct, so that
+    # it raises the same error as it would have otherwise)
+    if U32_ARRAY_TYPECODE is not None and offset + 4 + 4 * count <= len(data):
+        values = array.array(U32_ARRAY_TYPECODE)
+        values.frombytes(data[offset + 4 : offset + 4 + 4 * count])
+        if end != NATIVE_ENDIANNESS:
+            values.byteswap()
+        return values.tolist()
+
+    return list(u32_array_struct(end, count).unpack_from(data, offset + 4))
+
+
+def pack_u32_array_into(end: Endianness, buf: bytearray, offset: int, values: List[int]) -> int:
+    """
+    Pack a list of U32s, preceded by a U32 count, into buf at the given
+    offset, in a single call.
+    Returns the offset immediately following the packed data.
+    """
+    u32_array_struct(end, len(values) + 1).pack_into(buf, offset, len(values), *values)
+    return offset + 4 + 4 * len(values)
+
+
+def load_4b_length_prefixed_string(end: Endianness, data: bytes, offset:int=0) -> str:
+    """
+    Load a 4-byte length prefixed string from the given offset.
+    If data is a memoryview, the string is decoded straight from it,
+    without copying anything.
+    """
+    str_len = unpack_u32_from(end, data, offset)
+    return str(data[offset + 4 : offset + 4 + str_len], 'latin-1')
+
+
+def padded_string_size(length: int, num_null_terminators:int=4) -> int:
+    """
+    Get the total size of a 4-byte length prefixed padded string, given
+    the length of the encoded string itself.
     Most games add 4 null-terminator bytes to the end of each string,
     before aligning to multiples of 4 (so, 4-7 bytes of padding total).
     This was finally fixed in Kirby and the Forgotten Land, which now
     adds just one null terminator before aligning to 4.
     """
-    encoded = pack_u32(end, len(string))
-    encoded += string.encode('latin-1')
-    encoded += b'\0' * num_null_terminators
-    while len(encoded) % 4:
-        encoded += b'\0'
-    return encoded
+    return (4 + length + num_null_terminators + 3) & ~3
+
+
+def pack_4b_length_prefixed_padded_string_into(end: Endianness, buf: bytearray, offset: int, encoded: bytes, num_null_terminators:int=4) -> int:
+    """
+    Pack a 4-byte length prefixed string (already encoded) into buf at
+    the given offset. The null terminators and padding aren't written,
+    since buf is expected to be zero-filled already.
+    Returns the offset immediately following the padded string.
+    """
+    pack_u32_into(end, buf, offset, len(encoded))
+    buf[offset + 4 : offset + 4 + len(encoded)] = encoded
+    return offset + padded_string_size(len(encoded), num_null_terminators)
 
 
 def fnv1a_64(data: bytes) -> int:
@@ -85,11 +163,12 @@ def fnv1a_64(data: bytes) -> int:
     return hash
 
 
-def load_string_list(end: Endianness, data: bytes, offset_to_data: int) -> (List[str], Optional[Literal['fnv1a_64']]):
+def load_string_list(end: Endianness, data: bytes, offset: int, offset_to_data: int) -> (List[str], Optional[Literal['fnv1a_64']]):
     """
-    Load a string list. This consists of a 4-byte string count (call it
-    "n"), followed by n offsets, followed by the data region the offsets
-    point to. Each offset points to a 4-byte length-prefixed string.
+    Load a string list from the given offset. This consists of a 4-byte
+    string count (call it "n"), followed by n offsets, followed by the
+    data region the offsets point to. Each offset points to a 4-byte
+    length-prefixed string.
 
     The offset_to_data parameter is the absolute offset of the data
     being passed. This is needed in order to convert the absolute
@@ -100,18 +179,29 @@ def load_string_list(end: Endianness, data: bytes, offset_to_data: int) -> (List
     type of hash detected to be in use ('fnv1a_64' for Kirby and the
     Forgotten Land, None for all previous games).
     """
-    number_of_strings = unpack_u32(end, data[:4])
+    number_of_strings = unpack_u32_from(end, data, offset)
 
-    uses_hashes = (data[4:8] == b'\0\0\0\0')
+    uses_hashes = (data[offset + 4 : offset + 8] == b'\0\0\0\0')
 
+    # Read all of the string offsets at once
+    if uses_hashes:
+        # Each entry is 4 bytes of padding, an 8-byte hash, and then the
+        # 4-byte offset
+        entries = u32_array_struct(end, number_of_strings * 4).unpack_from(
+            data, offset + 4)
+        str_offs = entries[3::4]
+    else:
+        str_offs = u32_array_struct(end, number_of_strings).unpack_from(
+            data, offset + 4)
+
+    # This is load_4b_length_prefixed_string(), inlined, since there can
+    # be thousands of strings
+    u32_from = STRUCT_U32[end].unpack_from
     strs = []
-    for i in range(number_of_strings):
-        if uses_hashes:
-            str_off = unpack_u32_from(end, data, 16 + 16 * i)
-        else:
-            str_off = unpack_u32_from(end, data, 4 + 4 * i)
+    for str_off in str_offs:
         str_off -= offset_to_data
-        strs.append(load_4b_length_prefixed_string(end, data[str_off:]))
+        str_len, = u32_from(data, str_off)
+        strs.append(str(data[str_off + 4 : str_off + 4 + str_len], 'latin-1'))
 
     return strs, ('fnv1a_64' if uses_hashes else None)
 
@@ -122,20 +212,67 @@ def load_string_list(end: Endianness, data: bytes, offset_to_data: int) -> (List
 STRING_SORTING_PUNCTUATION_TABLE = '!"#$%&\'()*+,.-/:;<=>?@[\]^_`{|}~'
 
 
+def make_string_sorting_table() -> bytes:
+    """
+    Make a bytes.translate() table that maps each latin-1 character to
+    its rank in HAL's sorting order. (There are few enough distinct
+    ranks that they fit in a byte.)
+    """
+    # Oddly, punctuation sorts before everything else in this sorting scheme,
+    # and punctuation isn't even sorted according to ASCII. Everything else
+    # is sorted case-insensitively, by codepoint.
+    others = sorted({chr(c).lower() for c in range(256)} - set(STRING_SORTING_PUNCTUATION_TABLE))
+    ranks = {c: i for i, c in enumerate([*STRING_SORTING_PUNCTUATION_TABLE, *others])}
+    return bytes(ranks[chr(c).lower()] for c in range(256))
+
+
+STRING_SORTING_TABLE = make_string_sorting_table()
+
+
 def fdgh_string_sorting_key(s: str) -> Any:
     """
     Function that can be used to sort strings the same way HAL's tool does
     """
-    key = []
-    for c in s.lower():
-        # Oddly, punctuation sorts before everything else in this sorting scheme,
-        # and punctuation isn't even sorted according to ASCII
-        if c in STRING_SORTING_PUNCTUATION_TABLE:
-            key.append(STRING_SORTING_PUNCTUATION_TABLE.index(c) - 999999999999999)
-        else:
-            key.append(ord(c))
+    return s.encode('latin-1').translate(STRING_SORTING_TABLE)
 
-    return key
+
+def xml_escape_text(text: str) -> str:
+    """
+    Escape a string for use as XML element text, the same way
+    ElementTree does.
+    """
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def xml_escape_attrib(value: str) -> str:
+    """
+    Escape a string for use as an XML attribute value, the same way
+    ElementTree does.
+    """
+    return (xml_escape_text(value)
+        .replace('"', '&quot;')
+        .replace('\r', '&#13;')
+        .replace('\n', '&#10;')
+        .replace('\t', '&#09;'))
+
+
+def xml_text_line(tag: str, text: str, indent: int) -> str:
+    """
+    Format an XML element containing only text, on its own indented
+    line, the same way ElementTree does.
+    """
+    if text:
+        return f'{" " * indent}<{tag}>{xml_escape_text(text)}</{tag}>\n'
+    else:
+        return f'{" " * indent}<{tag} />\n'
+
+
+def xml_node_text(node: etree.Element) -> str:
+    """
+    Get the text of an XML node, with surrounding whitespace stripped.
+    Empty nodes (which have no text at all) give an empty string.
+    """
+    return (node.text or '').strip()
 
 
 def load_xbin(data: bytes) -> (Endianness, bytes, int, int):
@@ -147,7 +284,7 @@ def load_xbin(data: bytes) -> (Endianness, bytes, int, int):
     if len(data) < 16:
         raise ValueError('File is too short for XBIN')
 
-    end = {XBIN_MAGIC_BE: '>', XBIN_MAGIC_LE: '<'}.get(data[:6])
+    end = XBIN_MAGIC_ENDIANNESS.get(bytes(data[:6]))
     if end is None:
         raise ValueError('Incorrect XBIN magic')
 
@@ -161,12 +298,12 @@ def load_xbin(data: bytes) -> (Endianness, bytes, int, int):
     if version == 2:
         data_start = 0x10
 
-        filesize, metadata = struct.unpack_from(end + '2I', data, 8)
+        filesize, metadata = STRUCT_2U32[end].unpack_from(data, 8)
 
     elif version in {4, 5}:
         data_start = 0x14
 
-        filesize, metadata, colr_offset = struct.unpack_from(end + '3I', data, 8)
+        filesize, metadata, colr_offset = STRUCT_3U32[end].unpack_from(data, 8)
 
         filesize_aligned = (filesize + 3) & ~3
 
@@ -174,12 +311,13 @@ def load_xbin(data: bytes) -> (Endianness, bytes, int, int):
             raise ValueError(f'XBIN: filesize ({hex(filesize)})'
                              f' != COLR offset ({hex(colr_offset)})')
 
-        if end == '>':
-            expected_colr = b'COLR' + b'\0' * 8
-        else:
-            expected_colr = b'RLOC' + b'\0' * 8
-
-        assert data[colr_offset:] == expected_colr
+        # The COLR section must be exactly at the end of the file. (The
+        # length is checked first, so that only those 12 bytes are ever
+        # sliced out.)
+        expected_colr = ENDIANNESS_XBIN_COLR[end]
+        if (len(data) != colr_offset + len(expected_colr)
+                or data[colr_offset:] != expected_colr):
+            raise ValueError('XBIN: missing or incorrect COLR section')
 
     else:
         raise ValueError(f'Unknown XBIN version: {version}')
@@ -187,302 +325,379 @@ def load_xbin(data: bytes) -> (Endianness, bytes, int, int):
     return end, data[data_start:filesize], metadata, version
 
 
-def save_xbin(end: Endianness, data: bytes, metadata: int, version: int) -> bytes:
+def save_xbin(end: Endianness, data: bytes, metadata: int, version: int) -> bytearray:
     """
     Create a XBIN file of given version with the provided endianness
     ('>' or '<'), data, and metadata value.
+    (The bytearray it's built in is returned as-is, to avoid copying it.)
     """
-    xbin = bytearray({'>': XBIN_MAGIC_BE, '<': XBIN_MAGIC_LE}[end])
+    xbin = bytearray(ENDIANNESS_XBIN_MAGIC[end])
     xbin.append(version)
     xbin.append(0)
 
-    if version == 2:
-        header_len = 0x10
-    elif version in {4, 5}:
-        header_len = 0x14
-    else:
+    header_len = XBIN_HEADER_SIZES.get(version)
+    if header_len is None:
         raise ValueError(f'Unknown XBIN version: {version}')
 
-    xbin.extend(struct.pack(end + '2I', header_len + len(data), metadata))
+    xbin.extend(STRUCT_2U32[end].pack(header_len + len(data), metadata))
 
     if version in {4, 5}:
         xbin.extend(b'\0\0\0\0')  # actual value filled in later
 
     xbin.extend(data)
-    while len(xbin) % 4:
-        xbin.append(0)
+    xbin.extend(bytes(-len(xbin) & 3))  # align to 4
 
     if version in {4, 5}:
-        struct.pack_into(end + 'I', xbin, 0x10, len(xbin))
+        STRUCT_U32[end].pack_into(xbin, 0x10, len(xbin))
 
-        xbin.extend(b'COLR' if end == '>' else b'RLOC')
-        xbin.extend(b'\0' * 8)
+        xbin.extend(ENDIANNESS_XBIN_COLR[end])
 
-    return bytes(xbin)
+    return xbin
 
 
-def fdgh_to_xml(data: bytes, xbin_version: int) -> str:
+def fdgh_to_xml(data: bytes, xbin_version: int, include_comment:bool=True) -> str:
     """
     Convert binary FDGH data to a string containing an XML file.
+    The XML comment includes the current date and time, so it can be
+    left out if reproducible output is needed.
     """
 
     if len(data) < 16:
         raise ValueError('File is too short to be FDGH')
 
+    # Strings are loaded straight out of this, to avoid copying
+    data = memoryview(data)
+
     # Calculate the adjustment needed for all offset values due to the
     # XBIN header size
-    xbin_adj = {
-        2: -0x10,
-        4: -0x14,
-        5: -0x14,
-        }.get(xbin_version)
-    if xbin_adj is None:
+    if xbin_version not in XBIN_HEADER_SIZES:
         raise ValueError(f'Unknown XBIN version: {xbin_version}')
+    xbin_adj = -XBIN_HEADER_SIZES[xbin_version]
 
     # Main header: 20 bytes
-    end = {FDGH_MAGIC_BE: '>', FDGH_MAGIC_LE: '<'}.get(data[:4])
+    end = FDGH_MAGIC_ENDIANNESS.get(bytes(data[:4]))
     if end is None:
         raise ValueError('Incorrect FDGH magic')
     (world_map_unknown, world_map_start, room_offset_list_start,
-        asset_offset_list_start) = struct.unpack_from(end + '4I', data, 4)
+        asset_offset_list_start) = STRUCT_4U32[end].unpack_from(data, 4)
 
     # World map data: 4b count, then the values themselves
-    world_map_count = unpack_u32_from(end, data, world_map_start + xbin_adj)
-    world_map_indices = list(struct.unpack_from(
-        f'{end}{world_map_count}I', data, world_map_start + 4 + xbin_adj))
+    world_map_indices = unpack_u32_array_from(end, data, world_map_start + xbin_adj)
 
     # Room list: 4b count, then three offsets per room, then the data
     # region the offsets point to
-    room_list = [] # [('room_name',
-                   #   [asset_index, asset_index],
-                   #   [link_index, link_index]   )]
+    # (Stored as parallel lists, all indexed by room index)
+    room_names = []          # ['room_name', ...]
+    room_link_indices = []   # [[link_index, link_index], ...]
+    room_asset_indices = []  # [[asset_index, asset_index], ...]
     room_count = unpack_u32_from(end, data, room_offset_list_start + xbin_adj)
-    for i in range(room_count):
-
-        # Read the three offsets for this room
-        start_of_string, start_of_links, start_of_assets = struct.unpack_from(
-            end + 'III', data, room_offset_list_start + 4 + 12 * i + xbin_adj)
+    room_offsets = u32_array_struct(end, room_count * 3).unpack_from(
+        data, room_offset_list_start + 4 + xbin_adj)
+    # (Strided slices give the three offsets for each room without
+    # slicing out a separate tuple per room)
+    for start_of_string, start_of_links, start_of_assets in zip(
+            room_offsets[0::3], room_offsets[1::3], room_offsets[2::3]):
 
         # First offset: room name
-        room_name = load_4b_length_prefixed_string(end, data[start_of_string + xbin_adj:])
+        room_names.append(load_4b_length_prefixed_string(
+            end, data, start_of_string + xbin_adj))
 
         # Second offset: links to rooms with required assets (indices)
-        links_count = unpack_u32_from(end, data, start_of_links + xbin_adj)
-        links = []
-        for j in range(links_count):
-            idx = unpack_u32_from(end, data, start_of_links + 4 + 4 * j + xbin_adj)
-            links.append(idx)
+        room_link_indices.append(unpack_u32_array_from(
+            end, data, start_of_links + xbin_adj))
 
         # Third offset: links to required assets (indices)
-        assets_count = unpack_u32_from(end, data, start_of_assets + xbin_adj)
-        assets = []
-        for j in range(assets_count):
-            idx = unpack_u32_from(end, data, start_of_assets + 4 + 4 * j + xbin_adj)
-            assets.append(idx)
-
-        # Put them in the room list
-        room_list.append((room_name, links, assets))
+        room_asset_indices.append(unpack_u32_array_from(
+            end, data, start_of_assets + xbin_adj))
 
     # Assets list
     assets_list, asset_name_hash_type = load_string_list(
-        end, data[asset_offset_list_start + xbin_adj:], asset_offset_list_start)
+        end, data, asset_offset_list_start + xbin_adj, -xbin_adj)
 
     ################################################################
     ######################### Generate XML #########################
 
-    root = etree.Element('fdgh')
-    root.attrib['endian'] = {'>': 'big', '<': 'little'}[end]
-    root.attrib['xbin_version'] = str(xbin_version)
+    # The XML is written out directly instead of being built with
+    # ElementTree, since its structure is simple and this is much
+    # faster. The output is formatted exactly like ElementTree's would
+    # be (after etree.indent()).
+    root_attribs = {
+        'endian': ENDIANNESS_NAMES[end],
+        'xbin_version': str(xbin_version),
+    }
     if asset_name_hash_type is None:
-        root.attrib['num_string_null_terminators'] = '4'
+        root_attribs['num_string_null_terminators'] = '4'
     else:
-        root.attrib['num_string_null_terminators'] = '1'
-        root.attrib['asset_name_hashes'] = asset_name_hash_type
+        root_attribs['num_string_null_terminators'] = '1'
+        root_attribs['asset_name_hashes'] = asset_name_hash_type
+
+    # Each name is formatted just once, no matter how many times it's
+    # referenced
+    world_map_lines = [xml_text_line('room', room_name, 4) for room_name in room_names]
+    link_lines = [xml_text_line('link', room_name, 6) for room_name in room_names]
+    asset_lines = [xml_text_line('asset', asset, 6) for asset in assets_list]
+
+    parts = ["<?xml version='1.0' encoding='utf-8'?>\n<fdgh"]
+    for key, value in root_attribs.items():
+        parts.append(f' {key}="{xml_escape_attrib(value)}"')
+    parts.append('>\n')
 
     # Comment
-    root.append(etree.Comment(XML_COMMENT.format(datetime.datetime.now())))
+    if include_comment:
+        parts.append(f'  <!--{XML_COMMENT.format(datetime.datetime.now())}-->\n')
 
     # World map
-    world_map_node = etree.SubElement(root, 'worldmap',
-        attrib={'value': str(world_map_unknown)})
-    for idx in world_map_indices:
-        room_node = etree.SubElement(world_map_node, 'room')
-        room_node.text = room_list[idx][0]
+    parts.append(f'  <worldmap value="{world_map_unknown}"')
+    if world_map_indices:
+        parts.append('>\n')
+        parts.extend(world_map_lines[idx] for idx in world_map_indices)
+        parts.append('  </worldmap>\n')
+    else:
+        parts.append(' />\n')
 
     # Rooms
-    rooms_node = etree.SubElement(root, 'rooms')
-    for room_name, link_indices, asset_indices in room_list:
-        room_node = etree.SubElement(rooms_node, 'room',
-            attrib={'name': room_name})
-        for link_index in link_indices:
-            link_node = etree.SubElement(room_node, 'link')
-            link_node.text = room_list[link_index][0] # The name of the
-                                                      # room this link
-                                                      # points to
-        for asset_index in asset_indices:
-            asset_node = etree.SubElement(room_node, 'asset')
-            asset_node.text = assets_list[asset_index]
+    if room_names:
+        parts.append('  <rooms>\n')
+        for room_name, link_indices, asset_indices in zip(
+                room_names, room_link_indices, room_asset_indices):
+            parts.append(f'    <room name="{xml_escape_attrib(room_name)}"')
+            if link_indices or asset_indices:
+                parts.append('>\n')
+                parts.extend(link_lines[idx] for idx in link_indices)
+                parts.extend(asset_lines[idx] for idx in asset_indices)
+                parts.append('    </room>\n')
+            else:
+                parts.append(' />\n')
+        parts.append('  </rooms>\n')
+    else:
+        parts.append('  <rooms />\n')
 
-    # Return well-formed UTF-8 XML
-    if hasattr(etree, 'indent'):  # new in Python 3.9
-        etree.indent(root)
+    parts.append('</fdgh>')
 
-    return etree.tostring(root, encoding='unicode', xml_declaration=True)
+    return ''.join(parts)
 
 
-def xml_to_fdgh(data: str) -> bytes:
+def xml_to_fdgh(data: str) -> (Endianness, bytearray, int):
     """
     Convert a string containing an XML file to binary FDGH data.
+    Returns the endianness ('>' or '<'), the data, and the XBIN version.
+    (The bytearray it's built in is returned as-is, to avoid copying it.)
     """
 
+    world_map_unknown = DEFAULT_WORLDMAP_UNKNOWN_VALUE
     world_map_room_names = []
-    room_list = []
-
-    fdgh_root = etree.fromstring(data)
-    end = {'big': '>', 'little': '<'}.get(
-        fdgh_root.attrib.get('endian', 'big'), '>')
-    xbin_version = int(fdgh_root.attrib.get('xbin_version', '2'))
-    num_string_null_terminators = int(fdgh_root.attrib.get('num_string_null_terminators', 4))
-    asset_name_hash_type = fdgh_root.attrib.get('asset_name_hashes')
-    if asset_name_hash_type not in {None, 'fnv1a_64'}:
-        raise ValueError(f'Unsupported hash type: {asset_name_hashes}')
-
-    for container in fdgh_root:
-        if container.tag == 'worldmap':
+    # (Stored as parallel lists, all indexed by room index)
+    room_names = []
+    room_link_names = []
+    room_asset_names = []
+
+    # The XML is parsed incrementally, and each room element is cleared
+    # once it's been read, so that the whole tree is never in memory at
+    # once. "depth" is 1 for the root node, 2 for the containers (world
+    # map and rooms), and so on.
+    depth = 0
+    container_tag = None
+    for event, node in etree.iterparse(io.StringIO(data), events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+
+            if depth == 1:
+                # Root node: read the file settings
+                end = NAME_ENDIANNESS.get(node.attrib.get('endian', 'big'), '>')
+                xbin_version = int(node.attrib.get('xbin_version', '2'))
+                num_string_null_terminators = int(node.attrib.get('num_string_null_terminators', 4))
+                asset_name_hash_type = node.attrib.get('asset_name_hashes')
+                if asset_name_hash_type not in {None, 'fnv1a_64'}:
+                    raise ValueError(f'Unsupported hash type: {asset_name_hash_type}')
+
+            elif depth == 2:
+                container_tag = node.tag
+                if container_tag == 'worldmap':
+                    world_map_unknown = int(node.get(
+                        'value', DEFAULT_WORLDMAP_UNKNOWN_VALUE))
+
+            continue
+
+        depth -= 1
+        if depth != 2:
+            continue
+
+        # This is a complete child of a container
+        if container_tag == 'worldmap':
             # Parse world map data
+            if node.tag == 'room':
+                world_map_room_names.append(xml_node_text(node))
 
-            world_map_unknown = int(container.get(
-                'value', DEFAULT_WORLDMAP_UNKNOWN_VALUE))
-
-            for room in container:
-                if room.tag == 'room':
-                    world_map_room_names.append(room.text.strip())
-
-        elif container.tag == 'rooms':
+        elif container_tag == 'rooms':
             # Parse room data
+            room_names.append(node.attrib['name'])
 
-            for room in container:
-                room_name = room.attrib['name']
+            link_names = []
+            asset_names = []
+            for room_subnode in node:
+                if room_subnode.tag == 'link':
+                    link_names.append(xml_node_text(room_subnode))
+                elif room_subnode.tag == 'asset':
+                    asset_names.append(xml_node_text(room_subnode))
 
-                link_names = []
-                asset_names = []
-                for room_subnode in room:
-                    if room_subnode.tag == 'link':
-                        link_names.append(room_subnode.text.strip())
-                    elif room_subnode.tag == 'asset':
-                        asset_names.append(room_subnode.text.strip())
+            room_link_names.append(link_names)
+            room_asset_names.append(asset_names)
 
-                room_list.append((room_name, link_names, asset_names))
+        node.clear()
 
+    # Lookup table for room indices by name. If a name is used by more
+    # than one room, references to it resolve to the first one.
+    room_indices = {}
+    for i, room_name in enumerate(room_names):
+        room_indices.setdefault(room_name, i)
 
     ################################################################
     ######################### Generate FDGH ########################
 
     # This is difficult to do cleanly because this file uses absolute
     # offsets everywhere. We'll do the best we can.
+    # The size and position of everything is calculated first, so that
+    # the output can be allocated just once and then filled in place.
 
     # Step 0: calculate the adjustment needed for all offset values due
     # to the XBIN header size
-    xbin_adj = {
-        2: 0x10,
-        4: 0x14,
-        5: 0x14,
-        }.get(xbin_version)
+    xbin_adj = XBIN_HEADER_SIZES.get(xbin_version)
     if xbin_adj is None:
         raise ValueError(f'Unknown XBIN version: {xbin_version}')
 
-    # Step 1: start putting together a FDGH header
-    # That hardcoded value is the offset to the world map data, which is
-    # always at 0x24
-    magic = FDGH_MAGIC_BE if end == '>' else FDGH_MAGIC_LE
-    wm_data_offset = pack_u32(end, 0x14 + xbin_adj)
-    fdgh_head = magic + pack_u32(end, world_map_unknown) + wm_data_offset
-
-    # Step 2: put together the world map data
-    world_map_data = pack_u32(end, len(world_map_room_names))
+    # Step 1: find the room indices for the world map
+    world_map_indices = []
     for name in world_map_room_names:
         # Find the index of this name
-        for index, (room_name, _, _) in enumerate(room_list):
-            if room_name == name:
-                world_map_data += pack_u32(end, index)
-                break
-        else:
+        try:
+            world_map_indices.append(room_indices[name])
+        except KeyError:
             raise ValueError(f'Cannot find the room "{name}", which is'
                               ' referenced in the world map section.')
 
-    # Step 3: generate the assets list (the set-union of all assets
-    # needed by all rooms)
-    assets_list = []
-    for room_name, link_names, asset_names in room_list:
-        for asset in asset_names:
-            if asset not in assets_list:
-                assets_list.append(asset)
-    assets_list.sort(key=fdgh_string_sorting_key)
-
-    # Step 4: add the offset to the room-offset list and room data to
-    # the header
-    offset_to_room_header_data = 0x14 + len(world_map_data) + xbin_adj
-    fdgh_head += pack_u32(end, offset_to_room_header_data)
-    offset_to_room_data = offset_to_room_header_data + 4 + len(room_list) * 12
-
-    # Step 5: generate the data for each room and the offsets-list for
-    # it
-    room_offset_data = pack_u32(end, len(room_list))
-    room_data = b''
-    for room_name, link_names, asset_names in room_list:
-
-        # Room name
-        room_offset_data += pack_u32(end, offset_to_room_data + len(room_data))
-        room_data += pack_4b_length_prefixed_padded_string(end, room_name, num_string_null_terminators)
-
-        # Link names
-        room_offset_data += pack_u32(end, offset_to_room_data + len(room_data))
-        room_data += pack_u32(end, len(link_names))
+    # Step 2: generate the assets list (the set-union of all assets
+    # needed by all rooms). A dict is used as an insertion-ordered set,
+    # so that assets with equal sorting keys keep their relative order.
+    # The index lookup table has to be built after sorting.
+    assets_set = dict.fromkeys(
+        asset for asset_names in room_asset_names for asset in asset_names)
+    assets_list = sorted(assets_set, key=fdgh_string_sorting_key)
+    asset_indices = {asset: i for i, asset in enumerate(assets_list)}
+    encoded_assets = [asset.encode('latin-1') for asset in assets_list]
+
+    # Step 3: encode the room names, and find the room and asset indices
+    # for each room
+    encoded_room_names = [room_name.encode('latin-1') for room_name in room_names]
+
+    room_link_indices = []
+    for link_names in room_link_names:
+        link_indices = []
         for name in link_names:
             # Find the index of the level with this name
-            for other_idx, (other_name, _, _) in enumerate(room_list):
-                if other_name == name:
-                    break
-            else:
+            try:
+                link_indices.append(room_indices[name])
+            except KeyError:
                 raise ValueError(f'Cannot find the room matching "{name}".')
-
-            # Append this index as a U32
-            room_data += pack_u32(end, other_idx)
-
-        # Asset names
-        room_offset_data += pack_u32(end, offset_to_room_data + len(room_data))
-        room_data += pack_u32(end, len(asset_names))
-        for name in asset_names:
-            room_data += pack_u32(end, assets_list.index(name))
-
-    # Assets offset data needs to be aligned to 8, but only for KatFL
+        room_link_indices.append(link_indices)
+
+    room_asset_indices = [[asset_indices[name] for name in asset_names]
+                          for asset_names in room_asset_names]
+
+    # Step 4: lay out the sections (positions are relative to the start
+    # of the FDGH data; xbin_adj is only added when writing offsets).
+    # The world map data is always right after the 0x14-byte header.
+    world_map_pos = 0x14
+    room_offsets_pos = world_map_pos + 4 + 4 * len(world_map_indices)
+    room_data_pos = room_offsets_pos + 4 + 12 * len(room_names)
+
+    assets_offsets_pos = room_data_pos
+    for room_name in encoded_room_names:
+        assets_offsets_pos += padded_string_size(len(room_name), num_string_null_terminators)
+    for indices in room_link_indices:
+        assets_offsets_pos += 4 + 4 * len(indices)
+    for indices in room_asset_indices:
+        assets_offsets_pos += 4 + 4 * len(indices)
+
+    # Assets offset data needs to be aligned, but only for KatFL. Its
+    # position is padded to 4 mod 8, which (with the 0x14-byte XBIN v4
+    # header) puts the 64-bit hashes at multiples of 8 in the file.
     if asset_name_hash_type is not None:
-        while (len(fdgh_head) + len(world_map_data) + len(room_offset_data) + len(room_data)) % 8:
-            room_data += b'\0'
+        assets_offsets_pos += (4 - assets_offsets_pos) & 7
 
-    # Step 6: add the offset to the assets list to the header
-    offset_to_assets_header_list = offset_to_room_data + len(room_data)
-    fdgh_head += pack_u32(end, offset_to_assets_header_list)
     if asset_name_hash_type == 'fnv1a_64':
-        offset_to_assets_list = offset_to_assets_header_list + 4 + len(assets_list) * 16
+        assets_data_pos = assets_offsets_pos + 4 + len(encoded_assets) * 16
     else:
-        offset_to_assets_list = offset_to_assets_header_list + 4 + len(assets_list) * 4
-
-    # Step 7: generate the assets list itself
-    assets_offset_data = pack_u32(end, len(assets_list))
-    assets_data = b''
-    for asset in assets_list:
+        assets_data_pos = assets_offsets_pos + 4 + len(encoded_assets) * 4
+
+    total_size = assets_data_pos
+    for asset in encoded_assets:
+        total_size += padded_string_size(len(asset), num_string_null_terminators)
+
+    fdgh = bytearray(total_size)
+
+    # Structs for this endianness
+    u32 = STRUCT_U32[end]
+    u64 = STRUCT_U64[end]
+
+    # Step 5: write the FDGH header
+    fdgh[:4] = ENDIANNESS_FDGH_MAGIC[end]
+    STRUCT_4U32[end].pack_into(fdgh, 4,
+        world_map_unknown,
+        world_map_pos + xbin_adj,
+        room_offsets_pos + xbin_adj,
+        assets_offsets_pos + xbin_adj)
+
+    # Step 6: write the world map data
+    pack_u32_array_into(end, fdgh, world_map_pos, world_map_indices)
+
+    # Step 7: write the data for each room, collecting the three
+    # offsets for each one, and then the offsets-list all at once
+    room_offsets = []
+    pos = room_data_pos
+    for i in range(len(room_names)):
+        room_offsets.append(pos + xbin_adj)
+        pos = pack_4b_length_prefixed_padded_string_into(
+            end, fdgh, pos, encoded_room_names[i], num_string_null_terminators)
+        room_offsets.append(pos + xbin_adj)
+        pos = pack_u32_array_into(end, fdgh, pos, room_link_indices[i])
+        room_offsets.append(pos + xbin_adj)
+        pos = pack_u32_array_into(end, fdgh, pos, room_asset_indices[i])
+
+    u32.pack_into(fdgh, room_offsets_pos, len(room_names))
+    u32_array_struct(end, len(room_offsets)).pack_into(
+        fdgh, room_offsets_pos + 4, *room_offsets)
+
+    # Step 8: write the assets list itself
+    u32.pack_into(fdgh, assets_offsets_pos, len(encoded_assets))
+    entry_pos = assets_offsets_pos + 4
+    pos = assets_data_pos
+    for asset in encoded_assets:
         if asset_name_hash_type == 'fnv1a_64':
-            assets_offset_data += b'\0\0\0\0'
-            assets_offset_data += pack_u64(end, fnv1a_64(asset.encode('latin-1')))
-        assets_offset_data += pack_u32(end, offset_to_assets_list + len(assets_data))
-        assets_data += pack_4b_length_prefixed_padded_string(end, asset, num_string_null_terminators)
+            # 4 bytes of padding, then the hash
+            u64.pack_into(fdgh, entry_pos + 4, fnv1a_64(asset))
+            entry_pos += 12
+        u32.pack_into(fdgh, entry_pos, pos + xbin_adj)
+        entry_pos += 4
+        pos = pack_4b_length_prefixed_padded_string_into(
+            end, fdgh, pos, asset, num_string_null_terminators)
+
+    return end, fdgh, xbin_version
+
 
-    # Step 8: put it all together
-    return (end,
-            fdgh_head + world_map_data + room_offset_data + room_data
-                + assets_offset_data + assets_data,
-            xbin_version)
+def read_file_mapped(path: Path) -> memoryview:
+    """
+    Map a file into memory instead of reading it, so that only the parts
+    that are actually used get loaded. Slicing the returned memoryview
+    doesn't copy anything.
+    (The mapping isn't closed explicitly, since that isn't allowed while
+    views of it still exist; it's closed automatically once it's
+    unreferenced.)
+    """
+    with path.open('rb') as f:
+        # Empty files can't be mapped
+        if not f.seek(0, io.SEEK_END):
+            return memoryview(b'')
+        return memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ))
 
 
 def get_output_path(args: argparse.Namespace, auto_suffix: str) -> Path:
@@ -518,14 +733,19 @@ def main(argv:List[str]=None) -> None:
         help='output file (XML or FDGH)')
     parser.add_argument('--overwrite', action='store_true',
         help="overwrite the output file if it already exists (only needed if an output filename isn't explicitly specified)")
+    parser.add_argument('--no-comment', action='store_true',
+        help="don't add a comment with the current date and time when converting to XML (so that the output is reproducible)")
 
     args = parser.parse_args(argv)
 
     # Auto-detect input file format with some heuristics
     with args.input_file.open('rb') as f:
         first_1024 = f.read(1024)
+    # (The FDGH data always starts right after the XBIN header, so its
+    # magic only needs to be checked for there)
     input_is_xbin = (first_1024.startswith(XBIN_MAGIC)
-        and any(magic in first_1024 for magic in {FDGH_MAGIC_BE, FDGH_MAGIC_LE})
+        and any(first_1024[size : size + 4] in FDGH_MAGIC_ENDIANNESS
+                for size in set(XBIN_HEADER_SIZES.values()))
         and (b'\0' in first_1024))
     input_is_xml = ((b'<fdgh' in first_1024)
         and (b'\0' not in first_1024))
@@ -540,10 +760,14 @@ def main(argv:List[str]=None) -> None:
     if input_is_xbin:
         print('Converting FDGH to XML.')
 
-        xbin_data = args.input_file.read_bytes()
-
+        xbin_data = read_file_mapped(args.input_file)
         end, fdgh_data, metadata, xbin_version = load_xbin(xbin_data)
-        xml_data = fdgh_to_xml(fdgh_data, xbin_version)
+        xml_data = fdgh_to_xml(fdgh_data, xbin_version, not args.no_comment)
+
+        # Unmap the input file before writing, since it might be the
+        # output file too (and Windows doesn't allow truncating a file
+        # while it's mapped)
+        del xbin_data, fdgh_data
 
         output_fp.write_text(xml_data, encoding='utf-8')
 